@@ -1,7 +1,11 @@
 """ Dataloader for VISMA-depth formatted dataset.
 Assume triplet of images of the following form:
     (image at time t-1, reference image at time t, image at time t+1)
-and pickled dictionary object {'gwc': Nx3x4, 'Rg': Nx3x3} and calibration matrix
+and poses stored either as Nx3x7 array [gwc|Rg] in .npy format, or as pickled
+dictionary object {'gwc': Nx3x4, 'Rg': Nx3x3}, and calibration matrix
+The triplet is either one image concatenated horizontally, or N separate images
+whose filenames are listed under 'rgb' in a .json file next to the poses, or in the
+'rgb' entry of the pickled dictionary.
 """
 from __future__ import division
 import os
@@ -9,6 +13,7 @@ import random
 import tensorflow as tf
 import numpy as np
 import pickle
+import json
 
 # for testing
 import matplotlib.pyplot as plt
@@ -33,6 +38,38 @@ def make_homogeneous(mat3x4):
     """
     return np.concatenate([mat3x4, np.array([[0, 0, 0, 1]], dtype=np.float32)], axis=0)
 
+def load_pose(path):
+    """ Load the poses of a triplet.
+    Returns: dictionary object {'gwc': Nx3x4, 'Rg': Nx3x3}, with filenames of the images
+    under 'rgb' if they are stored separately.
+    """
+    if not path.endswith('.npy'):
+        with open(path, 'rb') as fid:
+            return pickle.load(fid)
+    pose = np.load(path)
+    datum = {'gwc': pose[..., :4], 'Rg': pose[..., 4:]}
+    names_path = path[:-4] + '.json'
+    if os.path.exists(names_path):
+        with open(names_path, 'r') as fid:
+            datum['rgb'] = [str(name) for name in json.load(fid)['rgb']]
+    return datum
+
+def load_triplet_paths(img_path, cam_path):
+    """ Get the paths of the images of a triplet. The layout is decided per triplet,
+    such that sequences stored either way can be mixed in one dataset.
+    Returns: [img_path] if the triplet is one image concatenated horizontally,
+    or the paths of its N images if they are stored separately.
+    """
+    if not os.path.exists(cam_path):
+        # no poses are given at test time, look for them next to the image
+        rgb_dir, name = os.path.split(img_path)
+        cam_path = os.path.join(os.path.dirname(rgb_dir), 'pose', os.path.splitext(name)[0])
+        cam_path = cam_path + '.npy' if os.path.exists(cam_path + '.npy') else cam_path + '.pkl'
+    names = load_pose(cam_path).get('rgb') if os.path.exists(cam_path) else None
+    if names is None:
+        return np.array([img_path])
+    return np.array([os.path.join(os.path.dirname(img_path), name) for name in names])
+
 class DataLoader(object):
     def __init__(self,
                  dataset_dir=None,
@@ -109,9 +146,17 @@ class DataLoader(object):
 
 
     def _load_func(self, img_path, cam_path, mask_path):
+        # paths of the images of the triplet, a single path if they are concatenated
+        triplet_paths = tf.py_func(load_triplet_paths, inp=[img_path, cam_path], Tout=tf.string)
+        is_concatenated = tf.equal(tf.size(triplet_paths), 1)
+
         # Load image sequence
         def _load_image_seq(img_path):
-            image_seq = tf.image.decode_jpeg(tf.read_file(img_path))
+            # images of the triplet stored separately are concatenated at load time
+            image_seq = tf.cond(is_concatenated,
+                    lambda: tf.image.decode_jpeg(tf.read_file(img_path)),
+                    lambda: tf.concat([tf.image.decode_jpeg(tf.read_file(triplet_paths[i]))
+                        for i in range(1 + self.num_source)], axis=1))
             tgt_image, src_image_stack = \
                 self.unpack_image_sequence(
                     image_seq, self.img_height, self.img_width, self.num_source)
@@ -133,9 +178,10 @@ class DataLoader(object):
 
         # for test & validation images, we also concatenate them, but only test/validate
         # the reference frame (middele one), so use the same loading function
-        tgt_image, src_image_stack = tf.cond(self.is_train,
+        # unless the images are stored separately
+        tgt_image, src_image_stack = tf.cond(tf.logical_or(self.is_train, is_concatenated),
                 lambda: _load_image_seq(img_path),
-                lambda: _load_image_seq(img_path))
+                lambda: _load_image(img_path))
 
         # normalize to [0, 1)
         tgt_image = tf.to_float(tgt_image) / 255.0
@@ -189,8 +235,7 @@ class DataLoader(object):
             Map formatted data file path to raw data file path.
             """
             def _py_load_pose(path):
-                with open(path, 'rb') as fid:
-                    datum = pickle.load(fid)
+                datum = load_pose(path)
                 # FIXME: not so sure, maybe need to inverse Rg first
                 # But the following implementation looks OK by checking the projection
                 # of gravity overlaid on image plane.
@@ -330,7 +375,9 @@ class DataLoader(object):
         # while in VOID, the files are split into different folders.
         all_list = dict()
         all_list['image'] = [os.path.join(dataroot, x) for x in frames]
-        all_list['camera'] = [os.path.join(dataroot, str.replace(x, 'rgb', 'pose')[:-4] + '.pkl') for x in frames]
+        # poses are stored in .npy format, or in .pkl format by older versions of the setup script
+        all_list['camera'] = [os.path.join(dataroot, str.replace(x, 'rgb', 'pose')[:-4]) for x in frames]
+        all_list['camera'] = [x + '.npy' if os.path.exists(x + '.npy') else x + '.pkl' for x in all_list['camera']]
         all_list['mask'] = [os.path.join(dataroot, str.replace(x, 'rgb', 'segmentation')[:-4] + '.npy') for x in frames]
         return all_list
 
@@ -44,8 +44,14 @@ class Validator(object):
             if which_camera == 'imx':
                 depth_file = image_file[:-4] + '_depth.npy'
             else:
-                depth_file = image_file.replace('rgb', 'depth')[:-4] + '.npy'
-            depth = np.load(depth_file)
+                depth_file = image_file.replace('rgb', 'depth')[:-4] + '.png'
+                if not os.path.exists(depth_file):
+                    depth_file = depth_file[:-4] + '.npy'
+            if depth_file.endswith('.png'):
+                # 16-bit png in millimeters
+                depth = cv2.imread(depth_file, cv2.IMREAD_ANYDEPTH).astype(np.float32) / 1000.0
+            else:
+                depth = np.load(depth_file)
 
             mask = np.logical_and(depth < 5, depth > 0)
             if np.any(mask):
@@ -54,6 +54,10 @@ if __name__ == '__main__':
             help='temporal interval (how many frames apart) between consecutive items in the triplets')
     parser.add_argument('--spatial-interval', type=float, default=0.01,
             help='spatial interval (least translation) between consecutive items in the triplets')
+    parser.add_argument('--split-triplets', default=False, action='store_true',
+            help='turn on to store each frame once as its own image instead of one concatenated image per triplet')
+    parser.add_argument('--io-workers', type=int, default=4,
+            help='number of background threads writing the outputs to disk, 0 to write in place')
     args = parser.parse_args()
 
     logging.set_verbosity(logging.INFO)
@@ -1,17 +1,22 @@
 """ Data preparation script for training depth completion on VOID dataset.
-Requirements: vlslam_pb2 generated by vlslam.proto and ROS.
+Requirements: vlslam_pb2 generated by vlslam.proto, ROS, and futures (on Python 2).
 Make sure you have the raw rosbag recorded and dataset file generated by vlslam.
 Author: Xiaohan Fei
 """
 import argparse, os, sys
 import numpy as np
-from scipy.interpolate import LinearNDInterpolator
-from scipy.spatial.qhull import QhullError
-import matplotlib.pyplot as plt
 from absl import logging
-from collections import deque as CircularBuffer
 import tempfile, shutil
-import pickle
+import mmap
+import json
+import threading
+from collections import deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from concurrent.futures import ThreadPoolExecutor
+from google.protobuf.internal.decoder import _DecodeVarint
 # ros
 import cv2
 import rosbag
@@ -25,6 +30,11 @@ MIN_Z = 0.2
 MAX_Z = 5.0
 valid_status = [vlslam_pb2.Feature.READY,
         vlslam_pb2.Feature.KEEP, vlslam_pb2.Feature.INSTATE, vlslam_pb2.Feature.GOODDROP]
+# most writes in flight, bounds the memory held by the images queued for writing
+MAX_PENDING_WRITES = 32
+# image encodings decoded without cv_bridge: encoding -> (dtype, number of channels)
+image_encodings = {'rgb8': (np.uint8, 3), 'bgr8': (np.uint8, 3), 'mono8': (np.uint8, 1),
+        '16UC1': (np.uint16, 1), 'mono16': (np.uint16, 1), '32FC1': (np.float32, 1)}
 
 def compose_pose(g1, g2):
   """ Compose two 3x4 pose matrices.
@@ -45,60 +55,368 @@ def inverse_pose(g1):
     g = np.concatenate((g, [[0, 0, 0, 1]]), axis=0)
   return g
 
+def triplet_parallax(gwc, temporal_interval=5, spatial_interval=0.01):
+    """ Check for all the triplets of a sequence of poses at once whether they have enough parallax.
+    The translation of g1^{-1} * g0 is R1.T * (t0 - t1), whose norm is |t0 - t1|,
+    so the camera centers suffice.
+    Args:
+        gwc: Nx3x4 poses of the frames the triplets are made of, in order
+        temporal_interval: how many frames apart
+        spatial_interval: least distance of t-1 and t+1 to the reference
+    Returns: boolean array of length N - 2 * temporal_interval, true for the triplet
+        made of the m-th, (m + temporal_interval)-th and (m + 2 * temporal_interval)-th frames
+        if it has enough parallax
+    """
+    t = gwc[:, :3, 3]
+    d = np.linalg.norm(t[temporal_interval:] - t[:-temporal_interval], axis=1)
+    return (d[:-temporal_interval] >= spatial_interval) & (d[temporal_interval:] >= spatial_interval)
+
 def list2pose(v):
     """ Convert a list of 12 floating-point numbers to a 3x4 pose matrix.
     Args:
-        v: list-like list of numbers
-    Returns: 3x4 matrix [R|t]
+        v: list-like list of numbers, or N such lists
+    Returns: 3x4 matrix [R|t], or Nx3x4 matrices if N lists are given
     """
-    return np.asarray(v).reshape((3, 4))
+    v = np.asarray(v)
+    return v.reshape((3, 4)) if v.ndim == 1 else v.reshape((-1, 3, 4))
 
 def list2R(wg):
     """ Convert 2-dim vector Wg to Rg, which is the rotation to align gravity to the canonical form [0, 0, 1]
     Args:
-        wg: list-like list of numbers
-    Returns: 3x3 matrix Rg
+        wg: list-like list of numbers, or N such lists
+    Returns: 3x3 matrix Rg, or Nx3x3 matrices if N lists are given
     """
-    Rg, _ = cv2.Rodrigues(np.asarray(list(wg) + [0]))
-    return Rg
-
-
-def construct_triplet(circbuf, temporal_interval=5, spatial_interval=0.01):
+    wg = np.asarray(wg, dtype=np.float64)
+    single = wg.ndim == 1
+    wg = wg.reshape((-1, 2))
+    # axis-angle -> rotation matrix by Rodrigues' formula, the 3rd component of Wg is always 0
+    theta = np.linalg.norm(wg, axis=1)
+    k = wg / np.where(theta > 0, theta, 1)[:, None]
+    K = np.zeros((wg.shape[0], 3, 3))
+    K[:, 0, 2], K[:, 1, 2] = k[:, 1], -k[:, 0]
+    K[:, 2, 0], K[:, 2, 1] = -k[:, 1], k[:, 0]
+    Rg = np.eye(3) + np.sin(theta)[:, None, None] * K \
+            + (1 - np.cos(theta))[:, None, None] * np.einsum('nij,njk->nik', K, K)
+    return Rg[0] if single else Rg
+
+
+def msg_to_array(msg, bridge):
+    """ Wrap the data of an image message into an array without copying it.
+    Args:
+        msg: sensor_msgs/Image message
+        bridge: CvBridge, used for encodings not in image_encodings
+    Returns: read-only HxW or HxWxC array viewing msg.data
+    """
+    if msg.encoding not in image_encodings:
+        return bridge.imgmsg_to_cv2(msg, desired_encoding='passthrough')
+    dtype, channels = image_encodings[msg.encoding]
+    dtype = np.dtype(dtype).newbyteorder('>' if msg.is_bigendian else '<')
+    shape = (msg.height, msg.width, channels)
+    # rows may be padded, so respect the row stride of the message
+    strides = (msg.step, channels * dtype.itemsize, dtype.itemsize)
+    if channels == 1:
+        shape, strides = shape[:2], strides[:2]
+    return np.ndarray(shape, dtype=dtype, buffer=msg.data, strides=strides)
+
+def load_dataset(path):
+    """ Load the camera and the trajectory from the dataset file generated by vlslam.
+    The file holds a single serialized Dataset message. Instead of parsing it as a whole,
+    its fields are walked over a memory map and packets are parsed one at a time,
+    such that only one Packet (with all its features) is alive at any time.
+    Args:
+        path: path to the dataset file
+    Returns: (CameraInfo, N timestamps, Nx12 gwc, Nx2 wg) of the N packets
+    """
+    fields = vlslam_pb2.Dataset.DESCRIPTOR.fields_by_name
+    camera_field, packets_field = fields['camera'].number, fields['packets'].number
+    cam = vlslam_pb2.CameraInfo()
+    packet = vlslam_pb2.Packet()
+    ts, gwc, wg = [], [], []
+    has_camera = False
+    with open(path, 'rb') as fid:
+        # mmap refuses empty files, which hold an empty Dataset
+        buf = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(fid.fileno()).st_size > 0 \
+                else bytearray()
+        try:
+            pos = 0
+            while pos < len(buf):
+                tag, pos = _DecodeVarint(buf, pos)
+                # all fields of Dataset are length-delimited
+                if tag & 7 != 2:
+                    raise ValueError('unexpected wire type {} in {}'.format(tag & 7, path))
+                size, pos = _DecodeVarint(buf, pos)
+                if tag >> 3 == camera_field:
+                    cam.MergeFromString(buf[pos:pos + size])
+                    has_camera = True
+                elif tag >> 3 == packets_field:
+                    packet.ParseFromString(buf[pos:pos + size])
+                    ts.append(packet.ts)
+                    gwc.append(list(packet.gwc))
+                    wg.append(list(packet.wg))
+                pos += size
+        finally:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+    # camera is a required field, which parsing the Dataset as a whole would have checked
+    if not has_camera:
+        raise ValueError('no camera in {}'.format(path))
+    return cam, np.array(ts), np.array(gwc).reshape((-1, 12)), np.array(wg).reshape((-1, 2))
+
+def message_timestamps(bag, topic):
+    """ Get the timestamps of the messages of a topic in a bag.
+    They are taken from the index of the bag without reading the messages. The index is
+    private to rosbag, so fall back to reading the messages if it is not available.
+    Args:
+        bag: rosbag.Bag
+        topic: topic of the messages
+    Returns: array of timestamps in seconds
+    """
+    if hasattr(bag, '_get_entries') and hasattr(bag, '_get_connections'):
+        return np.array([entry.time.to_sec()
+            for entry in bag._get_entries(bag._get_connections(topics=[topic]))])
+    logging.warn('index of the bag not available; reading the messages of {} for their timestamps'.format(
+            topic))
+    return np.array([msg.timestamp.to_sec() for msg in bag.read_messages(topics=[topic])])
+
+def match_timestamps(ts, ts_ref, dt):
+    """ Match each timestamp to the closest reference timestamp.
+    Args:
+        ts: N timestamps to match, in ascending order
+        ts_ref: M reference timestamps, in ascending order
+        dt: largest time difference of a match
+    Returns: N indices into ts_ref, -1 if no reference is within dt of the timestamp,
+        or if the reference has been matched to an earlier timestamp already
+    """
+    ts, ts_ref = np.asarray(ts), np.asarray(ts_ref)
+    if len(ts_ref) == 0:
+        return -np.ones(len(ts), dtype=np.int64)
+    right = np.clip(np.searchsorted(ts_ref, ts), 0, len(ts_ref) - 1)
+    left = np.clip(right - 1, 0, len(ts_ref) - 1)
+    index = np.where(np.abs(ts_ref[left] - ts) <= np.abs(ts_ref[right] - ts), left, right)
+    index[np.abs(ts_ref[index] - ts) > dt] = -1
+    # each reference is used at most once and in order
+    earlier = np.maximum.accumulate(np.concatenate(([-1], index[:-1])))
+    index[index <= earlier] = -1
+    return index
+
+class CircularBuffer(object):
+    """ Fixed-size circular buffer of tuples of the form
+        (rgb image, packet index, ground truth depth, output paths)
+    backed by preallocated arrays. As with deque, index 0 is the oldest item,
+    and appending to a full buffer overwrites the oldest item.
+    The arrays are allocated on the first append, after the shape and type of its images.
+    The depth is kept in millimeters as uint16, as it comes from the sensor.
+    """
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.rgb = None
+        self.index = np.empty(maxlen, dtype=np.int64)
+        self.depth = None
+        self.paths = [None] * maxlen
+        self.count = 0
+
+    def append(self, item):
+        rgb, index, depth, paths = item
+        if self.rgb is None:
+            self.rgb = np.empty((self.maxlen,) + rgb.shape, dtype=rgb.dtype)
+            self.depth = np.empty((self.maxlen,) + depth.shape, dtype=np.uint16)
+        if rgb.shape != self.rgb.shape[1:] or rgb.dtype != self.rgb.dtype:
+            raise ValueError('rgb image of shape {} and type {} differs from the first one '
+                    'of shape {} and type {}'.format(rgb.shape, rgb.dtype, self.rgb.shape[1:], self.rgb.dtype))
+        if depth.shape != self.depth.shape[1:]:
+            raise ValueError('depth image of shape {} differs from the first one of shape {}'.format(
+                    depth.shape, self.depth.shape[1:]))
+        head = self.count % self.maxlen
+        if depth.dtype.kind == 'f':
+            # float depth is in meters, invalid (nan) pixels become 0 as in the 16-bit depth
+            depth = np.clip(np.nan_to_num(np.round(depth * 1000)), 0, np.iinfo(np.uint16).max)
+        elif depth.dtype.kind != 'u' or depth.dtype.itemsize != 2:
+            raise ValueError('depth of type {} is neither 16-bit in millimeters nor float in meters'.format(
+                    depth.dtype))
+        self.rgb[head] = rgb
+        self.index[head] = index
+        self.depth[head] = depth
+        self.paths[head] = paths
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.maxlen)
+
+    def __getitem__(self, i):
+        """ Returns views into the buffer, which are overwritten once the item is evicted.
+        """
+        if not -len(self) <= i < len(self):
+            raise IndexError('circular buffer index out of range')
+        j = (self.count - len(self) + i % len(self)) % self.maxlen
+        return self.rgb[j], self.index[j], self.depth[j], self.paths[j]
+
+
+class MessagePrefetcher(threading.Thread):
+    """ Pull (rgb message, depth message) pairs from the bag on a background thread,
+    such that reading the bag overlaps with processing the frames.
+    The bag is read once, and only the pairs at the requested positions are kept,
+    where the k-th rgb message is paired with the k-th depth message.
+    """
+    def __init__(self, messages, color_topic, depth_topic, positions, maxsize=8):
+        super(MessagePrefetcher, self).__init__()
+        self.daemon = True
+        self.messages = messages
+        self.color_topic = color_topic
+        self.depth_topic = depth_topic
+        self.positions = positions
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stopped = threading.Event()
+        self.done = False
+
+    def run(self):
+        item = None
+        try:
+            wanted = set(self.positions)
+            positions = iter(self.positions)
+            k = next(positions, None)
+            counts = {self.color_topic: 0, self.depth_topic: 0}
+            kept = {self.color_topic: {}, self.depth_topic: {}}
+            for msg in self.messages:
+                if k is None or self.stopped.is_set():
+                    break
+                n = counts[msg.topic]
+                counts[msg.topic] += 1
+                if n not in wanted:
+                    continue
+                kept[msg.topic][n] = msg
+                # emit pairs in order as soon as both messages are read
+                while k is not None and k in kept[self.color_topic] and k in kept[self.depth_topic]:
+                    self.queue.put((kept[self.color_topic].pop(k), kept[self.depth_topic].pop(k)))
+                    k = next(positions, None)
+        except Exception as e:
+            # forward to the consumer
+            item = e
+        if not self.stopped.is_set():
+            self.queue.put(item)
+
+    def next(self):
+        """ Returns the next (rgb message, depth message) pair, and raises StopIteration
+        once the bag is exhausted as the message generators do.
+        """
+        if self.done:
+            raise StopIteration
+        item = self.queue.get()
+        if item is None or isinstance(item, Exception):
+            self.done = True
+            if item is None:
+                raise StopIteration
+            raise item
+        return item
+
+    def stop(self):
+        """ Stop prefetching, and unblock the thread if the queue is full.
+        """
+        self.stopped.set()
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+
+def allocate_triplet_buffers(rgb, split_rgb=False):
+    """ Allocate the buffers construct_triplet writes into, such that they can be reused across triplets.
+    Args:
+        rgb: one of the rgb images, the buffers take its size and type
+        split_rgb: if set, the rgb images are not concatenated and need no buffer
+    Returns: dictionary of buffers
+    """
+    out = {'gwc': np.empty((3, 3, 4)),
+            'Rg': np.empty((3, 3, 3)),
+            'pose': np.empty((3, 3, 7), dtype=np.float32)}
+    if not split_rgb:
+        out['rgb'] = np.empty((rgb.shape[0], 3 * rgb.shape[1]) + rgb.shape[2:], dtype=rgb.dtype)
+    return out
+
+def construct_triplet(circbuf, gwc_all, Rg_all, temporal_interval=5, split_rgb=False, out=None):
     """ Construct triplets as needed by training code.
     Args:
         cirbuf: list-like circular buffer containing tuples of the form
-            (rgb image, gwc, Rg, ground truth depth, output paths)
+            (rgb image, packet index, ground truth depth, output paths)
+        gwc_all: Nx3x4 poses of all the packets in the sequence
+        Rg_all: Nx3x3 gravity rotations of all the packets in the sequence
         temporal_interval: how many frames apart
-        spatial_interval: to ensure enough parallex
-    Returns: (3 rgb images concatenated along dimension 1,
-        Nx3x4 concatenated gwc along dimension 1,
-        Nx3x3 concatenated Rg along dimension 1,
+        split_rgb: if set, refer to the 3 rgb images by their output paths instead of concatenating them
+        out: buffers from allocate_triplet_buffers to write the triplet into, allocated if not given
+    Returns: (3 rgb images concatenated along dimension 1, or their 3 output paths if split_rgb,
+        3x3x7 float32 poses, with the 3x4 gwc and the 3x3 Rg of each image
+        concatenated along the last dimension,
         ground truth depth of the reference frame,
         output paths of the reference image)
     """
     ####################
     # concatenate pose
     ####################
-    gwc_concat = np.stack([circbuf[temporal_interval * i][1] for i in range(3)], axis=0)
-    Rg_concat = np.stack([circbuf[temporal_interval * i][2] for i in range(3)], axis=0)
-
-    # compose
-    g10 = compose_pose(inverse_pose(gwc_concat[1]), gwc_concat[0])
-    g12 = compose_pose(inverse_pose(gwc_concat[1]), gwc_concat[2])
-    if np.linalg.norm(g10[:3, 3]) < spatial_interval or np.linalg.norm(g12[:3, 3]) < spatial_interval:
-        raise ValueError('Not enough parallel!!!')
+    if out is None:
+        out = allocate_triplet_buffers(circbuf[0][0], split_rgb)
+    index = [circbuf[temporal_interval * i][1] for i in range(3)]
+    gwc_concat = np.take(gwc_all, index, axis=0, out=out['gwc'])
+    Rg_concat = np.take(Rg_all, index, axis=0, out=out['Rg'])
+    pose_concat = out['pose']
+    pose_concat[..., :4] = gwc_concat
+    pose_concat[..., 4:] = Rg_concat
 
     ####################
     # concatenate image
     ####################
-    rgb_concat = np.concatenate([circbuf[i * temporal_interval][0] for i in range(3)], axis=1)
+    if split_rgb:
+        rgb_triplet = [circbuf[i * temporal_interval][-1]['rgb'] for i in range(3)]
+    else:
+        rgb_triplet = np.concatenate([circbuf[i * temporal_interval][0] for i in range(3)], axis=1,
+                out=out['rgb'])
     # return
-    return (rgb_concat,
-            gwc_concat,
-            Rg_concat,
-            circbuf[temporal_interval][3],
+    return (rgb_triplet,
+            pose_concat,
+            circbuf[temporal_interval][2],
             circbuf[temporal_interval][-1])
 
+def _atomic_write_bytes(path, data):
+    """ Write an encoded buffer to path with a single write; readers never see a partial file.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fid:
+        fid.write(data)
+    os.rename(tmp_path, path)
+
+def _write_image(path, image, params):
+    """ Encode an image in memory in the format given by the extension of path and write it to path.
+    OpenCV releases the GIL while encoding, so this runs well on a worker thread.
+    """
+    ok, buf = cv2.imencode(os.path.splitext(path)[1], image, params)
+    if not ok:
+        raise IOError('failed to encode {}'.format(path))
+    _atomic_write_bytes(path, buf.tobytes())
+
+def _dump_pose(path, pose_concat, triplet=None):
+    """ Save the poses of a triplet to path, and the description of the triplet,
+    i.e., the filenames of its images and poses, to a .json file next to it if the
+    images are stored separately.
+    """
+    np.save(path, pose_concat)
+    if triplet is not None:
+        with open(os.path.splitext(path)[0] + '.json', 'w') as fid:
+            json.dump(triplet, fid)
+
+def _submit(executor, pending, func, *args):
+    """ Run func(*args) on the executor and keep track of it in pending,
+    or run it right away if there is no executor.
+    Blocks on the oldest write once more than MAX_PENDING_WRITES are in flight.
+    Returns: the future of the write, or None if it has been run right away
+    """
+    if executor is None:
+        func(*args)
+        return None
+    future = executor.submit(func, *args)
+    pending.append(future)
+    while len(pending) > MAX_PENDING_WRITES:
+        pending.popleft().result()
+    return future
+
 def process_one_sequence(opt):
     # bundle the 3 output folders in one to reduce hard driver addressing time in data loader?
     if len(opt.output_dir) == 0:
@@ -122,100 +440,131 @@ def process_one_sequence(opt):
 
     bag = rosbag.Bag(os.path.join(opt.work_dir, 'raw.bag'), 'r')
     bridge = CvBridge()
-    # bag.read_messages returns a generator, which can be iterated through via .next() function
-    color_messages = bag.read_messages(topics=[color_topic])
-    depth_messages = bag.read_messages(topics=[depth_topic])
+    ts_rgb = message_timestamps(bag, color_topic)
 
     # load dataset
-    dataset = vlslam_pb2.Dataset()
-    with open(os.path.join(opt.work_dir, 'dataset'), 'rb') as fid:
-        dataset.ParseFromString(fid.read())
-    cam = dataset.camera
-    rows, cols = cam.rows, cam.cols
+    cam, ts_all, gwc_all, wg_all = load_dataset(os.path.join(opt.work_dir, 'dataset'))
     K = np.array([[cam.radtan.fx, 0.0, cam.radtan.cx],
         [0, cam.radtan.fy, cam.radtan.cy],
         [0, 0, 1]])
 
-    logging.info('saving camera intrinsics')
-    np.save(os.path.join(output_dir, 'K'), K)
+    # poses and gravity rotations of all the packets, indexed by packet id in the main loop
+    gwc_all = list2pose(gwc_all)
+    Rg_all = list2R(wg_all)
 
     dt = 0.025  # within this threshold, two items are considered being captured at the same time instant
+    # position of the rgb (and depth) message of each packet in the bag, -1 if there is none
+    msg_index = match_timestamps(ts_all, ts_rgb, dt)
+    # bag.read_messages returns a generator, read it ahead on a separate thread
+    messages = MessagePrefetcher(bag.read_messages(topics=[color_topic, depth_topic]),
+            color_topic, depth_topic, msg_index[msg_index >= 0].tolist())
+    # parallax of the triplets of the frames in the circular buffer, indexed by their first frame
+    valid_triplet = triplet_parallax(gwc_all[msg_index >= 0], opt.temporal_interval, opt.spatial_interval)
+
+    logging.info('saving camera intrinsics')
+    np.save(os.path.join(output_dir, 'K'), K)
 
     circbuf_maxlen = opt.temporal_interval * 2 + 1
     circbuf = CircularBuffer(maxlen=circbuf_maxlen)
     count = 0
-
-    if opt.debug: plt.ion()
-    for i, packet in enumerate(dataset.packets):
-        now = packet.ts
-
-        rgb_msg = color_messages.next()
-        depth_msg = depth_messages.next()
-
-        while rgb_msg.timestamp.to_sec() < now - dt:
-            rgb_msg = color_messages.next()
-            depth_msg = depth_messages.next()
-
-        # while depth_msg.timestamp.to_sec() < now - dt:
-        #     depth_msg = depth_messages.next()
-
-        if rgb_msg.timestamp.to_sec() > now + dt:
-            logging.warn('bad sample, skipping ...')
-            continue
-
-        count += 1
-
-        # print('#{:04d}, [pose, rgb, depth_msg]=[{:0.4f}, {:0.4f},{:0.4f}]'.format(
-        #     count, now, rgb_msg.timestamp.to_sec(), depth_msg.timestamp.to_sec()))
-
-        rgb = bridge.imgmsg_to_cv2(rgb_msg.message, desired_encoding='passthrough')
-        depth = bridge.imgmsg_to_cv2(depth_msg.message, desired_encoding='passthrough')
-        depth = depth / 1000.0    # convert from millimeters to meters
-
-        basename = '{:.4f}'.format(now)
-        output_paths = {'rgb': os.path.join(rgb_output, basename + '.jpg'),
-                'pose': os.path.join(pose_output, basename + '.pkl'),
-                'depth': os.path.join(depth_output, basename + '.npy')}
-
-        gwc = list2pose(packet.gwc)
-        Rg = list2R(packet.wg)
-
-        circbuf.append((rgb, gwc, Rg, depth, output_paths))
-        if len(circbuf) == circbuf_maxlen:
-            # construct triplet and dump
-            try:
-                rgb_concat, gwc_concat, Rg_concat, dense_ref, ref_paths = construct_triplet(
-                        circbuf, opt.temporal_interval, opt.spatial_interval)
-                # saving
-                logging.info('saving ...')
-                basename = '{:.4f}'.format(now)
-
-                cv2.imwrite(ref_paths['rgb'], rgb_concat)
-                # plt.imsave(ref_paths['rgb'], rgb_concat)
-                with open(ref_paths['pose'], 'wb') as fid:
-                    pickle.dump({'gwc': gwc_concat, 'Rg': Rg_concat}, fid, protocol=0)
-
-                np.save(ref_paths['depth'], dense_ref.astype(np.float32))
+    # output buffers of the triplets, used in turn; a buffer is reused only after
+    # the writes reading from it have finished, allocated after the first image
+    triplet_bufs = [None] * (2 * max(opt.io_workers, 1))
+    triplet_writes = [[] for _ in triplet_bufs]
+    n_triplets = 0
+    # encoding parameters of the rgb images and the depth maps
+    jpeg_params = [cv2.IMWRITE_JPEG_QUALITY, 95]
+    png_params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+    # images already written, when each frame is stored separately
+    rgb_written = set()
+
+    # background writers for the outputs of the triplets, write in place if no worker is requested
+    executor = ThreadPoolExecutor(max_workers=opt.io_workers) if opt.io_workers > 0 else None
+    pending = deque()
+    messages.start()
+    # set once the loop finishes, errors of the writes must not mask the error the loop stopped with
+    done = False
+    try:
+        for i, now in enumerate(ts_all):
+
+            if msg_index[i] < 0:
+                logging.warn('bad sample, skipping ...')
+                continue
+
+            rgb_msg, depth_msg = messages.next()
+            count += 1
+
+            # print('#{:04d}, [pose, rgb, depth_msg]=[{:0.4f}, {:0.4f},{:0.4f}]'.format(
+            #     count, now, rgb_msg.timestamp.to_sec(), depth_msg.timestamp.to_sec()))
+
+            # views into the messages, the circular buffer keeps a copy
+            rgb = msg_to_array(rgb_msg.message, bridge)
+            depth = msg_to_array(depth_msg.message, bridge)
+
+            basename = '{:.4f}'.format(now)
+            output_paths = {'rgb': os.path.join(rgb_output, basename + '.jpg'),
+                    'pose': os.path.join(pose_output, basename + '.npy'),
+                    'depth': os.path.join(depth_output, basename + '.png')}
+
+            circbuf.append((rgb, i, depth, output_paths))
+            if len(circbuf) == circbuf_maxlen:
+                # construct triplet and dump
+                if not valid_triplet[count - circbuf_maxlen]:
+                    logging.warn('Not enough parallel; skip')
+                    continue
+                slot = n_triplets % len(triplet_bufs)
+                for future in triplet_writes[slot]:
+                    future.result()
+                if triplet_bufs[slot] is None:
+                    triplet_bufs[slot] = allocate_triplet_buffers(circbuf[0][0], opt.split_triplets)
+                rgb_triplet, pose_concat, dense_ref, ref_paths = construct_triplet(
+                        circbuf, gwc_all, Rg_all, opt.temporal_interval, opt.split_triplets, triplet_bufs[slot])
+                n_triplets += 1
+                # saving, named after the reference frame rather than the latest packet
+                basename = os.path.splitext(os.path.basename(ref_paths['rgb']))[0]
+                logging.info('saving {} ...'.format(basename))
+
+                # outputs are independent of each other, write them in the background
+                if opt.split_triplets:
+                    # a frame appears in up to 3 triplets, but is encoded and written only once
+                    for k, path in enumerate(rgb_triplet):
+                        if path not in rgb_written:
+                            # frame is a view into the circular buffer, which is overwritten before long
+                            frame = circbuf[opt.temporal_interval * k][0]
+                            _submit(executor, pending, _write_image, path, frame.copy(), jpeg_params)
+                            rgb_written.add(path)
+                    triplet = {'rgb': [os.path.basename(path) for path in rgb_triplet],
+                            'pose': os.path.basename(ref_paths['pose'])}
+                else:
+                    triplet = None
+                # writes reading from the buffers of the triplet
+                writes = [_submit(executor, pending, _dump_pose, ref_paths['pose'], pose_concat, triplet)]
+                if not opt.split_triplets:
+                    writes.append(
+                            _submit(executor, pending, _write_image, ref_paths['rgb'], rgb_triplet, jpeg_params))
+                triplet_writes[slot] = [future for future in writes if future is not None]
+                # dense_ref is a view into the circular buffer, which is overwritten before long
+                # 16-bit PNG in millimeters, which is lossless and compresses the smooth depth well
+                _submit(executor, pending, _write_image, ref_paths['depth'], dense_ref.copy(), png_params)
 
                 if opt.debug:
-                    im0, im1, im2 = np.split(rgb_concat, 3, axis=1)
-                    plt.clf()
-                    plt.subplot(221)
-                    plt.imshow(im1)
-                    plt.title('t')
-
-                    plt.subplot(222)
-                    plt.imshow(dense_ref)
-                    plt.title('dense depth of ref (mid)')
-
-                    plt.subplot(223)
-                    plt.imshow(im0)
-                    plt.title('t-1')
-
-                    plt.subplot(224)
-                    plt.imshow(im2)
-                    plt.title('t+1')
-
-                    plt.pause(0.01)
-            except ValueError:
-                logging.warn('Not enough parallel; skip')
+                    # t, dense depth of ref (mid)
+                    # t-1, t+1
+                    im0, im1, im2 = [cv2.cvtColor(circbuf[opt.temporal_interval * k][0], cv2.COLOR_RGB2BGR)
+                            for k in range(3)]
+                    depth_vis = cv2.applyColorMap(
+                            cv2.convertScaleAbs(dense_ref, alpha=255.0 / (MAX_Z * 1000)), cv2.COLORMAP_JET)
+                    mosaic = np.vstack([np.hstack([im1, depth_vis]), np.hstack([im0, im2])])
+                    cv2.imshow('triplet', mosaic)
+                    cv2.waitKey(1)
+        done = True
+    finally:
+        messages.stop()
+        # wait for all the writes to finish, and surface their errors if any
+        if executor is not None:
+            executor.shutdown(wait=True)
+        for future in pending:
+            if done:
+                future.result()
+            elif future.exception() is not None:
+                logging.error('write failed: {}'.format(future.exception()))